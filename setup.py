@@ -3,7 +3,8 @@
 from distutils.core import setup
 
 with open('requirements.txt') as f:
-    deps = [x for x in f.readlines()]
+    lines = (l.strip() for l in f.read().splitlines())
+    deps = [l for l in lines if l and not l.startswith('#')]
 
 setup(name="LdapCLI",
     version="1.0",
@@ -1,21 +1,19 @@
 #!/usr/bin/env python
 
+import atexit
 import click
-import ldap3
-import yaml
+import io
+import json
 import os
 import os.path
-from tabulate import tabulate
-from copy import copy
+import sys
+from collections import ChainMap
+from copy import copy, deepcopy
+import functools
 import logging
 import string
 import random
 
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
-
 # pasword field = userPassowrd
 LOG_LEVELS = {
     0: logging.ERROR,
@@ -59,45 +57,122 @@ GROUP_SPACING = '\n\t              '
 GROUP_ID_FIELD = 'cn'
 USER_ID_FIELD = 'uid'
 
+DEFAULT_CONFIG_FILE = os.path.expanduser("~/.ldapcli.yml")
+
 _logger = logging.getLogger('ldapcli')
 
+_yaml_mod = None
+Loader = None
+Dumper = None
+
+
+def _yaml():
+    global _yaml_mod, Loader, Dumper
+
+    if _yaml_mod is None:
+        import yaml
+
+        _yaml_mod = yaml
+        Loader = getattr(yaml, "CSafeLoader", None)
+        Dumper = getattr(yaml, "CSafeDumper", None)
+
+        if Loader is None or Dumper is None:
+            _logger.warning("PyYAML was built without libyaml; config parsing will use the slow pure-Python parser")
+            Loader = Loader or yaml.SafeLoader
+            Dumper = Dumper or yaml.SafeDumper
+
+    return _yaml_mod
+
+
+_config_cache = {}
+
 
 class LdapConfig:
 
     def __init__(self, d, c_profile='default'):
-        if d:
-            self.version = d.get("version")
-            self.defaults = d.get("defaults", {})
-            self.profiles = d.get("profiles")
-        else:
-            self.version = LATEST_CONFIG_VERSION
-            self.defaults = {}
-            self.profiles = {}
+        d = d or {}
+
+        self.version = d.get(CONFIG_VERSION, LATEST_CONFIG_VERSION)
+        self.defaults = d.get(CONFIG_DEFAULTS) or {}
+        self.profiles = d.get(CONFIG_PROFILES) or {}
 
-        self.current_profile_name = c_profile
+        self._current_profile_name = c_profile
+        self._current_profile = self.profiles.get(c_profile, {})
+        self._resolved = ChainMap(self._current_profile, self.defaults)
+        self._dirty = False
 
     @classmethod
     def load(cls, fn, c_profile='default'):
         try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return LdapConfig({}, c_profile)
+
+        stat_key = [st.st_mtime_ns, st.st_size]
+
+        cached = _config_cache.get(fn)
+        if cached and cached[0] == stat_key:
+            return LdapConfig(deepcopy(cached[1]), c_profile)
+
+        cache_fn = fn + ".cache.json"
+        conf = None
+
+        try:
+            with open(cache_fn) as f:
+                sidecar = json.load(f)
+            if sidecar.get("stat") == stat_key:
+                conf = sidecar.get("data")
+        except (OSError, ValueError):
+            pass
+
+        if conf is None:
+            yaml = _yaml()
             with open(fn) as f:
                 conf = yaml.load(f, Loader=Loader)
-        except FileNotFoundError:
-            conf = {}
 
-        return LdapConfig(conf, c_profile)
+            tmp = cache_fn + ".tmp"
+
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({"stat": stat_key, "data": conf}, f)
+                os.replace(tmp, cache_fn)
+            except (OSError, TypeError, ValueError):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+        _config_cache[fn] = (stat_key, conf)
+
+        return LdapConfig(deepcopy(conf), c_profile)
 
     def to_dict(self):
         return dict(version=".1", defaults=self.defaults, profiles=self.profiles)
 
     def to_yaml(self):
-        return yaml.dump(self.to_dict())
+        return _yaml().dump(self.to_dict(), Dumper=Dumper)
 
     def write(self, fn):
-        with open(fn, 'w') as f:
+        if not self._dirty:
+            return
+
+        try:
+            mode = os.stat(fn).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+
+        tmp = fn + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
             f.write(self.to_yaml())
+        os.chmod(tmp, mode)
+        os.replace(tmp, fn)
+
+        self._dirty = False
 
     def get(self, k, d=None):
-        return self.current_profile.get(k, self.defaults.get(k))
+        return self._resolved.get(k, d)
 
     @property
     def host_url(self):
@@ -115,12 +190,22 @@ class LdapConfig:
     def group_search_base(self):
         return self.get(PROF_GROUP_SEARCH_DN)
 
+    @property
+    def current_profile_name(self):
+        return self._current_profile_name
+
+    @current_profile_name.setter
+    def current_profile_name(self, name):
+        self._current_profile_name = name
+        self._current_profile = self.profiles.get(name, {})
+        self._resolved = ChainMap(self._current_profile, self.defaults)
+
     @property
     def current_profile(self):
-        return self.profiles.get(self.current_profile_name, {})
+        return self._current_profile
 
     def update_profile(self, new_values):
-        current_values = self.current_profile().copy()
+        current_values = self.current_profile.copy()
 
         for k, v in new_values.items():
             if v is not None:
@@ -132,15 +217,28 @@ class LdapConfig:
                     raise InvalidEntry(f"{c} not found in new profile")
 
         self.profiles[self.current_profile_name] = current_values
+        self._current_profile = current_values
+        self._resolved = ChainMap(self._current_profile, self.defaults)
+        self._dirty = True
+
+    def remove_profile(self):
+        if self.current_profile_name in self.profiles:
+            self.profiles.pop(self.current_profile_name)
+            self._current_profile = {}
+            self._resolved = ChainMap(self._current_profile, self.defaults)
+            self._dirty = True
 
 
+@functools.lru_cache(maxsize=4096)
 def __normalize_names(nm, base, id_field):
-    if nm.startswith(f"{id_field}="):
+    prefix = id_field + '='
+
+    if nm.startswith(prefix):
         dn = nm
-        name = nm[len(id_field) + 1:nm.index(',')]
+        name = nm[len(prefix):].partition(',')[0]
     else:
         name = nm
-        dn = f"{id_field}={nm},{base}"
+        dn = f"{prefix}{nm},{base}"
 
     return name, dn
 
@@ -153,14 +251,40 @@ def _normalize_group_names(nm, base):
     return __normalize_names(nm, base, GROUP_ID_FIELD)
 
 
-def _print_entry(entry, attributes, show_empty=True, separator=','):
-    print(entry.entry_dn)
+_stdout_buffered = False
+
+
+def _buffer_stdout():
+    global _stdout_buffered
+
+    if _stdout_buffered:
+        return
+
+    try:
+        if sys.stdout.isatty():
+            return
+        fd = os.dup(sys.stdout.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return
+
+    sys.stdout = io.TextIOWrapper(os.fdopen(fd, 'wb', buffering=1 << 16), encoding=sys.stdout.encoding or 'utf-8')
+    atexit.register(sys.stdout.flush)
+    _stdout_buffered = True
+
+
+def _print_entry(dn, attrs, attributes, show_empty=True, separator=','):
+    parts = [dn, '\n']
+
     for a in attributes:
+        v = attrs.get(a, [])
 
-        v = entry.entry_attributes_as_dict[a]
+        if not isinstance(v, (list, tuple)):
+            v = [v]
 
         if v or show_empty:
-            print(f"\t{a}: {separator.join(v)}")
+            parts.append(f"\t{a}: {separator.join(str(x) for x in v)}\n")
+
+    sys.stdout.write(''.join(parts))
 
 
 def set_verbosity(v):
@@ -175,43 +299,119 @@ class InvalidEntry(Exception):
         super().__init__(msg)
 
 
+@functools.lru_cache(maxsize=1024)
+def _eq_filter(field, value):
+    from ldap3.utils.conv import escape_filter_chars
+
+    return f"({field}={escape_filter_chars(str(value))})"
+
+
+def _first_value(attrs, name, default=None):
+    v = attrs.get(name)
+
+    if isinstance(v, (list, tuple)):
+        v = v[0] if v else None
+
+    return v if v is not None else default
+
+
+def _check_search_result(connect, msg):
+    result = connect.result
+
+    if connect.last_error or (result and result.get('result', 0) != 0):
+        raise click.ClickException(f"{msg}: {result}")
+
+
+_file_cache = {}
+
+
 def _retrieve_value(v):
     if v is None:
         return None
 
     if v.startswith("@"):
         fn = v[1:]
-        with open(fn, 'r') as f:
-            return f.read()
+        mtime = os.stat(fn).st_mtime_ns
+
+        cached = _file_cache.get(fn)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(fn, 'rb') as f:
+            data = f.read().decode()
+
+        _file_cache[fn] = (mtime, data)
+
+        return data
 
     return v
 
 
-def _connect_ldap(ctx):
-    config = ctx.obj[CTX_CONFIG]
+def _ctx(ctx):
+    obj = ctx.obj
+    return obj[CTX_CONFIG], obj[CTX_CONNECT]
+
 
-    passwd = config.get(PROF_BIND_PWD)
+_connections = {}
 
-    if not passwd:
-        passwd = click.prompt("Bind Password", hide_input=True)
+
+def _close_connections():
+    for c in _connections.values():
+        try:
+            c.unbind()
+        except Exception:
+            pass
+
+    _connections.clear()
+
+
+atexit.register(_close_connections)
+
+
+def _connect_ldap(ctx):
+    import ldap3
+
+    config = ctx.obj[CTX_CONFIG]
 
     host = config.host_url
     dn = config.bind_dn
 
-    _logger.debug(f"Connecting to {host} with {dn}")
-    s = ldap3.Server(host)
-    c = ldap3.Connection(s, user=dn, password=passwd)
+    c = _connections.get((host, dn))
+
+    if c is None:
+        passwd = config.get(PROF_BIND_PWD)
 
-    if not c.bind():
-        raise click.ClickException("Failed to bind to LDAP server")
+        if not passwd:
+            passwd = click.prompt("Bind Password", hide_input=True)
+
+        _logger.debug(f"Connecting to {host} with {dn}")
+
+        hosts = host.replace(',', ' ').split()
+
+        if len(hosts) > 1:
+            s = ldap3.ServerPool([ldap3.Server(h, get_info=ldap3.NONE, connect_timeout=5) for h in hosts],
+                                 ldap3.ROUND_ROBIN, active=True, exhaust=True)
+        else:
+            s = ldap3.Server(host, get_info=ldap3.NONE, connect_timeout=5)
+
+        c = ldap3.Connection(s, user=dn, password=passwd, client_strategy=ldap3.RESTARTABLE)
+
+        if not c.bind():
+            raise click.ClickException("Failed to bind to LDAP server")
+
+        _connections[(host, dn)] = c
 
     ctx.obj[CTX_CONNECT] = c
 
 
 def _add_user_to_groups(config, connect, user_dn, user_id, groups):
+    import ldap3
+
     if isinstance(groups, str):
         groups = [groups]
 
+    failures = []
+
     for g in groups:
         g_name, g_dn = _normalize_group_names(g, config.group_search_base)
 
@@ -224,22 +424,32 @@ def _add_user_to_groups(config, connect, user_dn, user_id, groups):
         }
 
         if not connect.modify(g_dn, mods):
-            raise click.ClickException(f"Failed to add user to group {g}: {connect.result}")
+            failures.append(f"{g}: {connect.result}")
+
+    if failures:
+        raise click.ClickException(f"Failed to add user to groups: {'; '.join(failures)}")
 
 
 def _remove_user_from_groups(config, connect, user_dn, groups):
+    import ldap3
+
+    failures = []
+
     for g in groups:
         g_name, g_dn = _normalize_group_names(g, config.group_search_base)
         _logger.debug(f"Removing {user_dn} from group {g_dn}")
         if not connect.modify(g_dn, {'uniqueMember': [(ldap3.MODIFY_DELETE, [user_dn])]}):
-            raise click.ClickException(f"Failed to remove user to group {g}: {connect.result}")
+            failures.append(f"{g}: {connect.result}")
+
+    if failures:
+        raise click.ClickException(f"Failed to remove user from groups: {'; '.join(failures)}")
 
 
 def _verify_entity_exists(ctx, entity, base, id_field):
     connect = ctx.obj[CTX_CONNECT]
     uid, dn = __normalize_names(entity, base, id_field)
 
-    if not connect.search(base, f"({id_field}={uid})"):
+    if not connect.search(base, _eq_filter(id_field, uid)):
         if connect.last_error:
             raise click.ClickException(f"Failed to find entity {connect.result}")
 
@@ -256,10 +466,29 @@ def _verify_group_exists(ctx, grp):
     return _verify_entity_exists(ctx, grp, conf.group_search_base, GROUP_ID_FIELD)
 
 
+def _next_available_id(conf, connect):
+    entries = connect.extend.standard.paged_search(conf.user_search_base, "(objectclass=person)",
+                                                   attributes=['uidNumber', 'gidNumber'],
+                                                   paged_size=500, generator=True)
+
+    max_id = 100
+
+    for r in entries:
+        if r.get('type') != 'searchResEntry':
+            continue
+
+        attrs = r['attributes']
+        tuid = int(_first_value(attrs, 'uidNumber', 0))
+        tgid = int(_first_value(attrs, 'gidNumber', 0))
+        max_id = max(max_id, tuid, tgid)
+
+    _check_search_result(connect, "Failed to query for uid")
+
+    return max_id + 1
+
+
 def _create_group(ctx, group_name, group_id, description=None):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
+    conf, connect = _ctx(ctx)
 
     group_name, group_dn = _normalize_group_names(group_name, conf.group_search_base)
 
@@ -276,14 +505,16 @@ def _create_group(ctx, group_name, group_id, description=None):
     if description:
         args['description'] = description
 
-    connect = obj[CTX_CONNECT]
     connect.add(group_dn, cls, args)
 
     return group_name, group_dn
 
 
-@click.group()
-@click.option("--config-file", "-c", default=os.path.join(os.getenv("HOME"), ".ldapcli.yml"))
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+@click.option("--config-file", "-c", default=DEFAULT_CONFIG_FILE)
 @click.option("--profile-name", "-n", default='default')
 @click.option("--verbose", "-v", count=True, help="Output level", default=1)
 @click.pass_context
@@ -297,14 +528,6 @@ def cli(ctx, config_file, profile_name, verbose):
     ctx.obj[CTX_CONFIG] = LdapConfig.load(config_file, profile_name)
 
 
-#@cli.result_callback
-@click.pass_context
-def user_cleanup(ctx, result, **kwargs):
-    if CTX_CONNECT in ctx.obj:
-        _logger.debug("Closing connection")
-        ctx.obj[CTX_CONNECT].unbind()
-
-
 def _gen_password(length=24):
     characters = list(string.ascii_letters + string.digits + "!@#$%^&*()")
 
@@ -327,10 +550,7 @@ def _gen_password(length=24):
 @click.pass_context
 def gen_minio(ctx):
     _connect_ldap(ctx)
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
-    connect = obj[CTX_CONNECT]
+    conf, connect = _ctx(ctx)
 
     if not connect.search(conf.user_search_base, "(objectclass=person)", attributes=['uid']):
         # Check if real error or just no records
@@ -366,51 +586,34 @@ def user(ctx):
 @click.option("--group", '-g', multiple=True, default=[], help="group to add users")
 @click.pass_context
 def user_create(ctx, username, commonname, public_key, uid, gid, home, surname, email, group):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
-    connect = obj[CTX_CONNECT]
+    conf, connect = _ctx(ctx)
 
-    next_id = 1
-
-    if uid is None:
-        if not connect.search(conf.user_search_base, "(objectclass=person)", attributes=['uid', 'gidNumber']):
-            # Check if real error or just no records
-            if connect.last_error:
-                raise click.ClickException(f"Failed to query for uid: {connect.result}")
+    if uid is None or gid is None:
+        next_id = _next_available_id(conf, connect)
+        _logger.debug(f"Next id: {next_id}")
 
-        max_uid = 100
-        max_gid = 100
+    if uid or gid:
+        probes = [_eq_filter(f, v) for f, v in (('uid', uid), ('gidNumber', gid)) if v]
+        flt = probes[0] if len(probes) == 1 else f"(|{''.join(probes)})"
 
-        for r in connect.entries:
-            max_uid = max(max_uid, r.entry_attributes_as_dict.get('uidNumber', [0])[0])
-            tgid = r.entry_attributes_as_dict.get('gidNumber', [0])
-            if tgid == []:
-                tgid = 0
-            else:
-                tgid = tgid[0]
-            max_gid = max(max_gid, tgid)
+        if not connect.search(conf.user_search_base, flt, attributes=['uid', 'gidNumber']):
+            raise click.ClickException(f"Failed to query for uid/gid: {connect.result}")
 
-        next_id = max(max_uid, max_gid) + 1
+        if connect.entries:
+            e = connect.entries[0]
 
-        _logger.debug(f"Next id: {next_id}")
+            if uid and 'uid' in e and str(uid).lower() in (str(x).lower() for x in e.uid.values):
+                raise click.ClickException(f"Entry with uid {uid} already exists")
 
-    if uid:
-        if not connect.search(conf.user_search_base, f"(uid={uid})"):
-            raise click.ClickException(f"Failed to query for uid: {connect.result}")
+            if gid:
+                raise click.ClickException(f"Entry with gid {gid} already exists")
 
-        if connect.entries:
             raise click.ClickException(f"Entry with uid {uid} already exists")
-    else:
-        uid = next_id
 
-    if gid:
-        if not connect.search(conf.user_search_base, f"(gidNumber={gid})"):
-            raise click.ClickException(f"Failed to query for gid: {connect.result}")
+    if not uid:
+        uid = next_id
 
-        if connect.entries:
-            raise click.ClickException(f"Entry with gid {gid} already exists")
-    else:
+    if not gid:
         gid = next_id
 
     if not home:
@@ -426,9 +629,9 @@ def user_create(ctx, username, commonname, public_key, uid, gid, home, surname,
 
     args = {
         'uid': username,
-        'uidNumber': next_id,
+        'uidNumber': uid,
         'homeDirectory': home,
-        'gidNumber': next_id,
+        'gidNumber': gid,
         'sn': surname,
         'mail': email,
         'cn': commonname
@@ -450,9 +653,9 @@ def user_create(ctx, username, commonname, public_key, uid, gid, home, surname,
 @click.option("--username", '-u', required=True, help="Username who's password to reset")
 @click.pass_context
 def user_passwd(ctx, username):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    connect = obj[CTX_CONNECT]
+    import ldap3
+
+    connect = ctx.obj[CTX_CONNECT]
 
     username, user_dn = _verify_user_exists(ctx, username)
 
@@ -468,12 +671,12 @@ def user_passwd(ctx, username):
 @click.option("--username", '-u', required=True, help="Username to update")
 @click.pass_context
 def user_public_key(ctx, username, public_key):
-    obj = ctx.obj
+    import ldap3
+
+    connect = ctx.obj[CTX_CONNECT]
     u_name, u_dn = _verify_user_exists(ctx, username)
 
     pk = _retrieve_value(public_key).encode('utf-8')
-
-    connect = obj[CTX_CONNECT]
     if not connect.modify(u_dn, dict(sshPublicKey=[(ldap3.MODIFY_REPLACE, pk)])):
         raise click.ClickException(f"Failed to change public key for {u_dn}")
 
@@ -484,41 +687,39 @@ def user_public_key(ctx, username, public_key):
 @click.option("--show-empty/--hide-empty", default=True, help="Display empty attributes")
 @click.pass_context
 def user_display(ctx, username, attribute, show_empty):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    _buffer_stdout()
+    config, connect = _ctx(ctx)
 
     if username:
         u_name, u_dn = _normalize_user_names(username, config.user_search_base)
-        result = connect.search(config.user_search_base, f'(uid={u_name})', attributes=attribute)
-
+        flt = _eq_filter('uid', u_name)
     else:
-        result = connect.search(config.user_search_base, '(objectclass=person)', attributes=attribute)
+        flt = '(objectclass=person)'
 
-    if result:
-        for r in connect.entries:
-            _print_entry(r, attribute, show_empty)
+    entries = connect.extend.standard.paged_search(config.user_search_base, flt, attributes=attribute,
+                                                   paged_size=500, generator=True)
+
+    for r in entries:
+        if r.get('type') == 'searchResEntry':
+            _print_entry(r['dn'], r['attributes'], attribute, show_empty)
 
 
 @user.command(name='list')
 @click.option("--attribute", '-a', multiple=True, default=['dn'])
 @click.pass_context
 def user_list(ctx, attribute):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    from tabulate import tabulate
+
+    config, connect = _ctx(ctx)
 
     attribute = [x.lower() for x in attribute]
     result = connect.search(config.user_search_base, '(objectclass=person)', attributes=attribute)
 
-    table = []
     if result:
-        for r in connect.entries:
-            d = r.entry_attributes_as_dict
-            d['dn'] = r.entry_dn
-
-            t = [d.get(x) for x in attribute]
-            table.append(t)
+        rows = ([r.entry_dn if x == 'dn' else (r[x].values if x in r else None) for x in attribute]
+                for r in connect.entries)
 
-        print(tabulate(table, headers=attribute))
+        print(tabulate(rows, headers=attribute))
 
 
 @user.group(name='group')
@@ -531,8 +732,7 @@ def user_group():
 @click.option("--group", '-g', multiple=True, required=True, help="group to add users")
 @click.pass_context
 def user_group_add(ctx, username, group):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    config, connect = _ctx(ctx)
 
     username, u_dn = _verify_user_exists(ctx, username)
 
@@ -544,8 +744,7 @@ def user_group_add(ctx, username, group):
 @click.option("--group", '-g', multiple=True, required=True, help="groups to remove user")
 @click.pass_context
 def user_group_add(ctx, username, group):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    config, connect = _ctx(ctx)
 
     username, u_dn = _verify_user_exists(ctx, username)
 
@@ -556,17 +755,16 @@ def user_group_add(ctx, username, group):
 @click.option("--username", '-u', required=True, help="User to remove")
 @click.pass_context
 def user_group_display(ctx, username):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    config, connect = _ctx(ctx)
 
     username, u_dn = _verify_user_exists(ctx, username)
 
-    if not connect.search(config.group_search_base, f"(uniqueMember={u_dn})"):
+    if not connect.search(config.group_search_base, _eq_filter('uniqueMember', u_dn)):
         if connect.last_error:
             raise click.ClickException(f"Failed to query groups: {connect.result}")
 
     for r in connect.entries:
-        _print_entry(r, [], separator='\n')
+        print(r.entry_dn)
 
 
 @cli.group()
@@ -578,70 +776,84 @@ def group(ctx):
 @group.command()
 @click.pass_context
 def fix_groups(ctx):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    import ldap3
 
-    result = connect.search(config.group_search_base, '(objectclass=groupOfUniqueNames)',
-                            attributes=['uniqueMember', 'memberUid', 'objectClass', 'gidNumber'])
+    config, connect = _ctx(ctx)
+
+    # First pass: only groups still missing the posixGroup class need it added
+    entries = connect.extend.standard.paged_search(config.group_search_base,
+                                                   '(&(objectclass=groupOfUniqueNames)(!(objectclass=posixGroup)))',
+                                                   attributes=['gidNumber'], paged_size=500, generator=True)
 
     next_gid = 20000
 
-    for e in connect.entries:
+    for e in entries:
+        if e.get('type') != 'searchResEntry':
+            continue
+
+        mods = {'objectClass': [(ldap3.MODIFY_ADD, ['posixGroup'])]}
+
+        if not e['attributes'].get('gidNumber'):
+            mods['gidNumber'] = [(ldap3.MODIFY_ADD, [next_gid])]
+            next_gid += 1
+
+        if not connect.modify(e['dn'], mods):
+            raise click.ClickException(f"Failed up update group {e['dn']}: {connect.result}")
+
+    # Second pass: membership sync only needs the two membership attributes
+    entries = connect.extend.standard.paged_search(config.group_search_base, '(objectclass=groupOfUniqueNames)',
+                                                   attributes=['uniqueMember', 'memberUid'],
+                                                   paged_size=500, generator=True)
+
+    for e in entries:
+        if e.get('type') != 'searchResEntry':
+            continue
+
+        attrs = e['attributes']
         mods = {}
 
-        if 'posixGroup' not in e.objectClass.values:
-            mods['objectClass'] = [(ldap3.MODIFY_ADD, ['posixGroup'])]
-            if not e.gidNumber:
-                mods['gidNumber'] = [(ldap3.MODIFY_ADD, [next_gid])]
-                next_gid += 1
+        member_uids = set(attrs.get('memberUid', []))
 
-        for g in e.uniqueMember.values:
+        for g in attrs.get('uniqueMember', []):
             if g != 'cn=Directory Manager':
                 uid, udn = _normalize_user_names(g, config.user_search_base)
 
-                if uid not in e.memberUid.values:
+                if uid not in member_uids:
+                    member_uids.add(uid)
                     mods.setdefault('memberUid', []).append((ldap3.MODIFY_ADD, [uid]))
 
         if mods:
-            if not connect.modify(e.entry_dn, mods):
-                raise click.ClickException(f"Failed up update group {g}: {connect.result}")
+            if not connect.modify(e['dn'], mods):
+                raise click.ClickException(f"Failed up update group {e['dn']}: {connect.result}")
 
 
-def _convert_values_bytes(d):
-    results = {}
+def _enc(s):
+    return s.encode('utf-8') if isinstance(s, str) else s
 
-    for k, v in d.items():
-        if isinstance(v, str):
-            v = v.encode('utf-8')
-        elif isinstance(v, (tuple, list)):
-            v = [x.encode('utf-8') for x in v]
 
-        if v is not None:
-            results[k] = v
+def _convert_values_bytes(d):
+    enc = _enc
 
-    return results
+    return {k: ([enc(x) for x in v] if isinstance(v, (tuple, list)) else enc(v))
+            for k, v in d.items() if v is not None}
 
 
 @group.command(name='list')
 @click.option("--attribute", '-a', multiple=True, default=['dn'])
 @click.pass_context
 def group_list(ctx, attribute):
-    connect = ctx.obj['connect']
-    config = ctx.obj[CTX_CONFIG]
+    from tabulate import tabulate
+
+    config, connect = _ctx(ctx)
 
     attribute = [x.lower() for x in attribute]
     result = connect.search(config.group_search_base, '(objectclass=groupofuniquenames)', attributes=attribute)
 
-    table = []
     if result:
-        for r in connect.entries:
-            d = r.entry_attributes_as_dict
-            d['dn'] = r.entry_dn
-
-            t = [d.get(x) for x in attribute]
-            table.append(t)
+        rows = ([r.entry_dn if x == 'dn' else (r[x].values if x in r else None) for x in attribute]
+                for r in connect.entries)
 
-        print(tabulate(table, headers=attribute))
+        print(tabulate(rows, headers=attribute))
 
 
 @group.command(name="create")
@@ -657,14 +869,14 @@ def group_create(ctx, group_name, description):
 @click.option("--attribute", "-a", multiple=True)
 @click.pass_context
 def group_display(ctx, group_name, attribute):
-    connect = ctx.obj[CTX_CONNECT]
-    config = ctx.obj[CTX_CONFIG]
+    _buffer_stdout()
+    config, connect = _ctx(ctx)
 
     attribute = list(attribute)
 
     filter = "(objectclass=posixGroup)"
     if group_name:
-        filter = f"(&{filter}(cn={group_name}))"
+        filter = f"(&{filter}{_eq_filter('cn', group_name)})"
 
     g_dn = config.group_search_base
     _logger.debug(f"Searching groups in {g_dn}")
@@ -673,27 +885,26 @@ def group_display(ctx, group_name, attribute):
     if 'uniqueMember' not in attribute:
         attribute.append('uniqueMember')
 
-    results = connect.search(g_dn, filter, attributes=attribute)
+    entries = connect.extend.standard.paged_search(g_dn, filter, attributes=attribute,
+                                                   paged_size=500, generator=True)
 
-    if results:
-        for r in connect.entries:
-            _print_entry(r, attribute, separator=GROUP_SPACING)
-    else:
-        raise click.ClickException("Failed to retrieve groups")
+    for r in entries:
+        if r.get('type') == 'searchResEntry':
+            _print_entry(r['dn'], r['attributes'], attribute, separator=GROUP_SPACING)
+
+    _check_search_result(connect, "Failed to retrieve groups")
 
 
 @group.command(name='remove')
 @click.option("--group", "-g", help='Name of group', required=True)
 @click.pass_context
 def group_remove(ctx, group):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
+    conf, connect = _ctx(ctx)
 
     group_name, group_dn = _normalize_group_names(group, conf.group_search_base)
 
     _logger.debug(f"Removing Group {group_dn}")
-    obj[CTX_CONNECT].delete(group_dn)
+    connect.delete(group_dn)
 
 
 @group.group(name='user')
@@ -706,30 +917,36 @@ def group_user():
 @click.option("--user", "-u", multiple=True, help="Users to add to group", default=[])
 @click.pass_context
 def group_user_add(ctx, group, user):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
-    connect = obj[CTX_CONNECT]
+    import ldap3
 
-    id, dn = _verify_group_exists(ctx, group)
+    conf, connect = _ctx(ctx)
 
-    if not connect.search(conf.group_search_base, f'({GROUP_ID_FIELD}={id})', attributes=['uniqueId']):
-    #if not connect.search(conf.group_search_base, f'({GROUP_ID_FIELD}={id})'):
-        raise click.ClickException(f"Failed to query group {dn}: {connect.result}")
+    g_id, g_dn = _verify_group_exists(ctx, group)
 
-    current_members = set(connect.entries[0].uniqueId.values)
+    if not connect.search(conf.group_search_base, _eq_filter(GROUP_ID_FIELD, g_id), attributes=['uniqueMember']):
+        raise click.ClickException(f"Failed to query group {g_dn}: {connect.result}")
 
-    new_members = []
+    entry = connect.entries[0]
+    members = frozenset(entry.uniqueMember.values if 'uniqueMember' in entry else ())
+
+    add_dns = []
+    add_uids = []
 
     for u in user:
-        id, u_dn = _normalize_user_names(u, conf.user_search_base)
+        u_id, u_dn = _normalize_user_names(u, conf.user_search_base)
 
-        if id not in current_members:
-            new_members.append((ldap3.MODIFY_ADD, id))
+        if u_dn not in members:
+            add_dns.append(u_dn)
+            add_uids.append(u_id)
 
-    if new_members:
-        if not connect.modify(dn, {'uniqueUid': new_members}):
-            raise click.ClickException("Failed to add users to group")
+    if add_dns:
+        mods = {
+            'uniqueMember': [(ldap3.MODIFY_ADD, add_dns)],
+            'memberUid': [(ldap3.MODIFY_ADD, add_uids)]
+        }
+
+        if not connect.modify(g_dn, mods):
+            raise click.ClickException(f"Failed to add users to group {g_dn}: {connect.result}")
 
 
 @group_user.command(name='remove')
@@ -737,10 +954,9 @@ def group_user_add(ctx, group, user):
 @click.option("--user", "-u", multiple=True, help="Users to remove from group", default=[])
 @click.pass_context
 def group_user_remove(ctx, group, user):
-    ctx.ensure_object(dict)
-    obj = ctx.obj
-    conf = obj[CTX_CONFIG]
-    connect = obj[CTX_CONNECT]
+    import ldap3
+
+    conf, connect = _ctx(ctx)
 
     id, dn = _verify_group_exists(ctx, group)
 
@@ -762,13 +978,13 @@ def profile():
 @click.option("--all", '-a', is_flag=True, default=False, help="Display all configs")
 @click.pass_context
 def profile_display(ctx, all):
-    ctx.ensure_object(dict)
-
     conf = ctx.obj[CTX_CONFIG]
+    yaml = _yaml()
+
     if not all:
-        print(yaml.dump({conf.current_profile_name: conf.current_profile()}))
+        print(yaml.dump({conf.current_profile_name: conf.current_profile}, Dumper=Dumper))
     else:
-        print(yaml.dump(conf.profiles))
+        print(yaml.dump(conf.profiles, Dumper=Dumper))
 
 
 def prompt(txt, arg_value=None, current_value=None, required=False):
@@ -831,7 +1047,7 @@ def profile_remove(ctx):
     conf = ctx.obj[CTX_CONFIG]
 
     _logger.debug(f"Removing profile {conf.current_profile_name}")
-    conf.profiles.pop(conf.current_profile_name)
+    conf.remove_profile()
     conf.write(ctx.obj[CTX_CONFIG_FILE])
 
 